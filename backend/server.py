@@ -1,18 +1,29 @@
-from fastapi import FastAPI, APIRouter, HTTPException, Depends, Request, Response, status
+from fastapi import FastAPI, APIRouter, HTTPException, Depends, Request, Response, BackgroundTasks, Query, status
 from fastapi.security import HTTPBearer, HTTPAuthorizationCredentials
+from fastapi.responses import ORJSONResponse
 from dotenv import load_dotenv
 from starlette.middleware.cors import CORSMiddleware
-from motor.motor_asyncio import AsyncIOMotorClient
+from pymongo import AsyncMongoClient, ReturnDocument
+from pymongo.errors import DuplicateKeyError, PyMongoError
 import os
+import asyncio
 import logging
 from pathlib import Path
 from pydantic import BaseModel, Field, ConfigDict, EmailStr
 from typing import List, Optional, Dict, Any
 import uuid
+import json
+import hashlib
+import threading
+import time
 from datetime import datetime, timezone, timedelta
+from concurrent.futures import ProcessPoolExecutor
 import bcrypt
 import jwt
-import requests
+from cachetools import TLRUCache, TTLCache
+import redis.asyncio as aioredis
+from redis.exceptions import RedisError
+import httpx
 from enum import Enum
 
 ROOT_DIR = Path(__file__).parent
@@ -20,20 +31,56 @@ load_dotenv(ROOT_DIR / '.env')
 
 # MongoDB connection
 mongo_url = os.environ['MONGO_URL']
-client = AsyncIOMotorClient(mongo_url)
+client = AsyncMongoClient(mongo_url, tz_aware=True, tzinfo=timezone.utc)
 db = client[os.environ['DB_NAME']]
 
+# Redis session cache (optional, sessions fall back to MongoDB when unset)
+redis_url = os.environ.get('REDIS_URL')
+redis_client = aioredis.from_url(redis_url, decode_responses=True) if redis_url else None
+SESSION_EXPIRE_SECONDS = 7 * 24 * 60 * 60
+
 # JWT Configuration
 SECRET_KEY = os.environ.get('JWT_SECRET_KEY', 'your-secret-key-change-in-production')
 ALGORITHM = "HS256"
 ACCESS_TOKEN_EXPIRE_MINUTES = 10080  # 7 days
 
+# Decoded JWT cache (token digest -> payload), entries expire at the token's exp
+TOKEN_CACHE_MAX_SIZE = 10000
+TOKEN_CACHE_MAX_TTL = 3600  # seconds
+token_cache = TLRUCache(
+    maxsize=TOKEN_CACHE_MAX_SIZE,
+    ttu=lambda _key, payload, now: now + min(payload['exp'] - time.time(), TOKEN_CACHE_MAX_TTL),
+)
+token_cache_lock = threading.Lock()
+
+# Users resolved from JWTs, briefly cached to skip a lookup per request
+USER_CACHE_MAX_SIZE = 10000
+USER_CACHE_TTL = 60  # seconds
+user_cache = TTLCache(maxsize=USER_CACHE_MAX_SIZE, ttl=USER_CACHE_TTL)
+
+# bcrypt runs in worker processes so hashing never blocks the event loop
+BCRYPT_ROUNDS = 10
+BCRYPT_MAX_PENDING = 500
+bcrypt_pool: Optional[ProcessPoolExecutor] = None
+bcrypt_slots = asyncio.Semaphore(BCRYPT_MAX_PENDING)
+
+# Read notifications older than the retention window are swept daily
+NOTIFICATION_RETENTION_DAYS = 90
+NOTIFICATION_SWEEP_INTERVAL = 24 * 60 * 60  # seconds
+notification_sweeper: Optional[asyncio.Task] = None
+
+# Shared HTTP client for outbound calls, reuses pooled connections
+http_client: Optional[httpx.AsyncClient] = None
+
 # Create the main app
-app = FastAPI()
+app = FastAPI(default_response_class=ORJSONResponse)
 api_router = APIRouter(prefix="/api")
 
 security = HTTPBearer(auto_error=False)
 
+def utc_now() -> datetime:
+    return datetime.now(timezone.utc)
+
 # Enums
 class UserRole(str, Enum):
     ADMIN = "admin"
@@ -64,14 +111,14 @@ class RequestType(str, Enum):
 # Models
 class User(BaseModel):
     model_config = ConfigDict(extra="ignore")
-    id: str = Field(default_factory=lambda: str(uuid.uuid4()))
+    id: str = Field(default_factory=lambda: uuid.uuid4().hex)
     email: EmailStr
     name: str
     role: UserRole
     password_hash: Optional[str] = None
     picture: Optional[str] = None
     is_active: bool = True
-    created_at: str = Field(default_factory=lambda: datetime.now(timezone.utc).isoformat())
+    created_at: datetime = Field(default_factory=utc_now)
 
 class UserCreate(BaseModel):
     email: EmailStr
@@ -85,15 +132,15 @@ class UserLogin(BaseModel):
 
 class SessionData(BaseModel):
     model_config = ConfigDict(extra="ignore")
-    id: str = Field(default_factory=lambda: str(uuid.uuid4()))
+    id: str = Field(default_factory=lambda: uuid.uuid4().hex)
     user_id: str
     session_token: str
-    expires_at: str
-    created_at: str = Field(default_factory=lambda: datetime.now(timezone.utc).isoformat())
+    expires_at: datetime
+    created_at: datetime = Field(default_factory=utc_now)
 
 class WorkOrder(BaseModel):
     model_config = ConfigDict(extra="ignore")
-    id: str = Field(default_factory=lambda: str(uuid.uuid4()))
+    id: str = Field(default_factory=lambda: uuid.uuid4().hex)
     request_id: str
     title: str
     description: str
@@ -114,8 +161,32 @@ class WorkOrder(BaseModel):
     total_cost: float = 0.0
     created_by_id: str
     created_by_name: str
-    created_at: str = Field(default_factory=lambda: datetime.now(timezone.utc).isoformat())
-    updated_at: str = Field(default_factory=lambda: datetime.now(timezone.utc).isoformat())
+    created_at: datetime = Field(default_factory=utc_now)
+    updated_at: datetime = Field(default_factory=utc_now)
+
+class WorkOrderSummary(BaseModel):
+    model_config = ConfigDict(extra="ignore")
+    id: str
+    request_id: str
+    title: str
+    description: str  # truncated preview
+    status: WorkOrderStatus
+    request_type: RequestType
+    sla_type: SLAType
+    location: str
+    client_name: str
+    assigned_to_name: Optional[str] = None
+    due_date: Optional[str] = None
+    total_cost: float = 0.0
+    created_at: datetime
+
+# List views only need a short description preview
+DESCRIPTION_PREVIEW_LENGTH = 200
+WORK_ORDER_SUMMARY_PROJECTION = {
+    "_id": 0,
+    **{field: 1 for field in WorkOrderSummary.model_fields},
+    "description": {"$substrCP": ["$description", 0, DESCRIPTION_PREVIEW_LENGTH]}
+}
 
 class WorkOrderCreate(BaseModel):
     title: str
@@ -147,13 +218,13 @@ class WorkOrderUpdate(BaseModel):
 
 class Comment(BaseModel):
     model_config = ConfigDict(extra="ignore")
-    id: str = Field(default_factory=lambda: str(uuid.uuid4()))
+    id: str = Field(default_factory=lambda: uuid.uuid4().hex)
     work_order_id: str
     user_id: str
     user_name: str
     user_role: UserRole
     content: str
-    created_at: str = Field(default_factory=lambda: datetime.now(timezone.utc).isoformat())
+    created_at: datetime = Field(default_factory=utc_now)
 
 class CommentCreate(BaseModel):
     work_order_id: str
@@ -161,14 +232,14 @@ class CommentCreate(BaseModel):
 
 class CostEntry(BaseModel):
     model_config = ConfigDict(extra="ignore")
-    id: str = Field(default_factory=lambda: str(uuid.uuid4()))
+    id: str = Field(default_factory=lambda: uuid.uuid4().hex)
     work_order_id: str
     description: str
     cost_type: str  # "material" or "labor"
     amount: float
     created_by_id: str
     created_by_name: str
-    created_at: str = Field(default_factory=lambda: datetime.now(timezone.utc).isoformat())
+    created_at: datetime = Field(default_factory=utc_now)
 
 class CostEntryCreate(BaseModel):
     work_order_id: str
@@ -178,7 +249,7 @@ class CostEntryCreate(BaseModel):
 
 class PreventiveMaintenance(BaseModel):
     model_config = ConfigDict(extra="ignore")
-    id: str = Field(default_factory=lambda: str(uuid.uuid4()))
+    id: str = Field(default_factory=lambda: uuid.uuid4().hex)
     title: str
     description: str
     location: str
@@ -187,7 +258,7 @@ class PreventiveMaintenance(BaseModel):
     assigned_to_id: Optional[str] = None
     assigned_to_name: Optional[str] = None
     is_active: bool = True
-    created_at: str = Field(default_factory=lambda: datetime.now(timezone.utc).isoformat())
+    created_at: datetime = Field(default_factory=utc_now)
 
 class PreventiveMaintenanceCreate(BaseModel):
     title: str
@@ -199,13 +270,13 @@ class PreventiveMaintenanceCreate(BaseModel):
 
 class Notification(BaseModel):
     model_config = ConfigDict(extra="ignore")
-    id: str = Field(default_factory=lambda: str(uuid.uuid4()))
+    id: str = Field(default_factory=lambda: uuid.uuid4().hex)
     user_id: str
     title: str
     message: str
     link: Optional[str] = None
     is_read: bool = False
-    created_at: str = Field(default_factory=lambda: datetime.now(timezone.utc).isoformat())
+    created_at: datetime = Field(default_factory=utc_now)
 
 class CompanySettings(BaseModel):
     model_config = ConfigDict(extra="ignore")
@@ -215,7 +286,7 @@ class CompanySettings(BaseModel):
     primary_color: str = "#3b82f6"
     secondary_color: str = "#10b981"
     timezone: str = "UTC"
-    updated_at: str = Field(default_factory=lambda: datetime.now(timezone.utc).isoformat())
+    updated_at: datetime = Field(default_factory=utc_now)
 
 class CompanySettingsUpdate(BaseModel):
     company_name: Optional[str] = None
@@ -226,37 +297,133 @@ class CompanySettingsUpdate(BaseModel):
 
 # Helper Functions
 def hash_password(password: str) -> str:
-    return bcrypt.hashpw(password.encode('utf-8'), bcrypt.gensalt()).decode('utf-8')
+    return bcrypt.hashpw(password.encode('utf-8'), bcrypt.gensalt(rounds=BCRYPT_ROUNDS)).decode('utf-8')
 
 def verify_password(password: str, hashed: str) -> bool:
     return bcrypt.checkpw(password.encode('utf-8'), hashed.encode('utf-8'))
 
+def password_needs_rehash(hashed: str) -> bool:
+    # Hashes look like $2b$<cost>$<salt+digest>
+    try:
+        return int(hashed.split('$')[2]) != BCRYPT_ROUNDS
+    except (IndexError, ValueError):
+        return False
+
+async def run_bcrypt(func, *args):
+    # Shed load instead of queueing unbounded work behind the pool
+    if bcrypt_slots.locked():
+        raise HTTPException(status_code=503, detail="Server busy, please retry", headers={"Retry-After": "1"})
+    async with bcrypt_slots:
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(bcrypt_pool, func, *args)
+
 def create_access_token(data: dict) -> str:
     to_encode = data.copy()
-    expire = datetime.now(timezone.utc) + timedelta(minutes=ACCESS_TOKEN_EXPIRE_MINUTES)
+    expire = utc_now() + timedelta(minutes=ACCESS_TOKEN_EXPIRE_MINUTES)
     to_encode.update({"exp": expire})
     return jwt.encode(to_encode, SECRET_KEY, algorithm=ALGORITHM)
 
 def decode_token(token: str) -> Dict[str, Any]:
+    # Skip signature verification for tokens we have already validated
+    cache_key = hashlib.blake2b(token.encode('utf-8'), digest_size=16).digest()
+    with token_cache_lock:
+        payload = token_cache.get(cache_key)
+    if payload is not None:
+        return payload
+    
     try:
         payload = jwt.decode(token, SECRET_KEY, algorithms=[ALGORITHM])
-        return payload
     except jwt.ExpiredSignatureError:
         raise HTTPException(status_code=401, detail="Token has expired")
-    except jwt.JWTError:
+    except jwt.InvalidTokenError:
         raise HTTPException(status_code=401, detail="Invalid token")
+    
+    if 'exp' in payload:
+        with token_cache_lock:
+            token_cache[cache_key] = payload
+    return payload
+
+def session_cache_entry(user_data: Dict[str, Any]) -> Dict[str, Any]:
+    return {
+        "id": user_data['id'],
+        "email": user_data['email'],
+        "name": user_data['name'],
+        "role": user_data['role'],
+        "picture": user_data.get('picture')
+    }
+
+async def cache_session(session_token: str, user_data: Dict[str, Any], ttl: int = SESSION_EXPIRE_SECONDS) -> bool:
+    if not redis_client or ttl <= 0:
+        return False
+    try:
+        await redis_client.setex(f"session:{session_token}", ttl, json.dumps(session_cache_entry(user_data)))
+    except RedisError as e:
+        logger.warning(f"Failed to cache session: {e}")
+        return False
+    return True
+
+async def get_cached_session(session_token: str) -> Optional[User]:
+    if not redis_client:
+        return None
+    try:
+        cached = await redis_client.get(f"session:{session_token}")
+    except RedisError as e:
+        logger.warning(f"Failed to read cached session: {e}")
+        return None
+    return User(**json.loads(cached)) if cached else None
+
+async def delete_cached_sessions(session_tokens: List[str]):
+    if not redis_client or not session_tokens:
+        return
+    # Revocation must not be skipped, a surviving key keeps the session alive
+    try:
+        await redis_client.delete(*[f"session:{token}" for token in session_tokens])
+    except RedisError as e:
+        logger.error(f"Failed to delete cached sessions: {e}")
+        raise HTTPException(status_code=503, detail="Session store unavailable, please retry", headers={"Retry-After": "1"})
+
+async def invalidate_user_sessions(user_id: str):
+    # Drop cached sessions so role/status changes apply on the next request
+    if not redis_client:
+        return
+    sessions = await db.sessions.find({"user_id": user_id}, {"_id": 0, "session_token": 1}).to_list(1000)
+    await delete_cached_sessions([s['session_token'] for s in sessions])
+
+async def get_user_by_id(user_id: str) -> Optional[Dict[str, Any]]:
+    user_data = user_cache.get(user_id)
+    if user_data is None:
+        user_data = await db.users.find_one({"id": user_id}, {"_id": 0, "password_hash": 0})
+        if user_data:
+            user_cache[user_id] = user_data
+    return user_data
 
 async def get_current_user(request: Request) -> User:
     # Check cookie first
     session_token = request.cookies.get("session_token")
     
     if session_token:
-        # Check session in database
-        session = await db.sessions.find_one({"session_token": session_token})
+        # Check session cache, then the database
+        user = await get_cached_session(session_token)
+        if user:
+            return user
+        
+        now = utc_now()
+        session = await db.sessions.find_one({"session_token": session_token, "expires_at": {"$gt": now}})
         if session:
-            expires_at = datetime.fromisoformat(session['expires_at'])
-            if expires_at > datetime.now(timezone.utc):
-                user_data = await db.users.find_one({"id": session['user_id']}, {"_id": 0})
+            user_data = await db.users.find_one({"id": session['user_id']}, {"_id": 0})
+            if user_data and user_data.get('is_active'):
+                ttl = int((session['expires_at'] - now).total_seconds())
+                if await cache_session(session_token, user_data, ttl):
+                    # A logout or user update may have landed between the reads
+                    # above and the write, drop the entry if it is now stale
+                    still_valid, current = await asyncio.gather(
+                        db.sessions.find_one({"session_token": session_token, "expires_at": {"$gt": now}}, {"_id": 1}),
+                        db.users.find_one({"id": user_data['id']}, {"_id": 0, "password_hash": 0})
+                    )
+                    if (not still_valid or not current or not current.get('is_active')
+                            or session_cache_entry(current) != session_cache_entry(user_data)):
+                        await delete_cached_sessions([session_token])
+                        user_data = current if still_valid else None
                 if user_data and user_data.get('is_active'):
                     return User(**user_data)
     
@@ -265,23 +432,64 @@ async def get_current_user(request: Request) -> User:
     if auth_header and auth_header.startswith("Bearer "):
         token = auth_header.split(" ")[1]
         payload = decode_token(token)
-        user_data = await db.users.find_one({"id": payload.get("user_id")}, {"_id": 0})
+        user_data = await get_user_by_id(payload.get("user_id"))
         if user_data and user_data.get('is_active'):
             return User(**user_data)
     
     raise HTTPException(status_code=401, detail="Not authenticated")
 
 def require_role(allowed_roles: List[UserRole]):
+    allowed = frozenset(allowed_roles)
     async def role_checker(current_user: User = Depends(get_current_user)):
-        if current_user.role not in allowed_roles:
+        if current_user.role not in allowed:
             raise HTTPException(status_code=403, detail="Insufficient permissions")
         return current_user
     return role_checker
 
+def work_order_scope(user: User) -> Dict[str, Any]:
+    # Restrict work order queries to the ones the user may see
+    if user.role == UserRole.CLIENT:
+        return {"client_id": user.id}
+    if user.role == UserRole.TECHNICIAN:
+        return {"assigned_to_id": user.id}
+    return {}
+
+async def check_work_order_scope(work_order_id: str, user: User):
+    # Admins and supervisors see every work order, skip the lookup for them
+    scope = work_order_scope(user)
+    if scope and not await db.work_orders.find_one({"id": work_order_id, **scope}, {"_id": 0, "id": 1}):
+        raise HTTPException(status_code=404, detail="Work order not found")
+
+async def next_sequence(name: str) -> int:
+    counter = await db.counters.find_one_and_update(
+        {"_id": name},
+        {"$inc": {"seq": 1}},
+        upsert=True,
+        return_document=ReturnDocument.AFTER
+    )
+    return counter['seq']
+
 async def create_notification(user_id: str, title: str, message: str, link: Optional[str] = None):
     notif = Notification(user_id=user_id, title=title, message=message, link=link)
     await db.notifications.insert_one(notif.model_dump())
 
+async def sweep_read_notifications():
+    while True:
+        cutoff = utc_now() - timedelta(days=NOTIFICATION_RETENTION_DAYS)
+        try:
+            # Older notifications store created_at as an ISO string, match those too
+            result = await db.notifications.delete_many({
+                "is_read": True,
+                "$or": [
+                    {"created_at": {"$lt": cutoff}},
+                    {"created_at": {"$lt": cutoff.isoformat()}}
+                ]
+            })
+            logger.info(f"Removed {result.deleted_count} read notifications older than {NOTIFICATION_RETENTION_DAYS} days")
+        except PyMongoError as e:
+            logger.warning(f"Failed to sweep notifications: {e}")
+        await asyncio.sleep(NOTIFICATION_SWEEP_INTERVAL)
+
 # Auth Routes
 @api_router.post("/auth/register")
 async def register(user_data: UserCreate):
@@ -295,9 +503,12 @@ async def register(user_data: UserCreate):
         email=user_data.email,
         name=user_data.name,
         role=user_data.role,
-        password_hash=hash_password(user_data.password)
+        password_hash=await run_bcrypt(hash_password, user_data.password)
     )
-    await db.users.insert_one(user.model_dump())
+    try:
+        await db.users.insert_one(user.model_dump())
+    except DuplicateKeyError:
+        raise HTTPException(status_code=400, detail="Email already registered")
     
     # Create token
     token = create_access_token({"user_id": user.id, "email": user.email})
@@ -313,12 +524,17 @@ async def login(credentials: UserLogin):
     if not user_data or not user_data.get('password_hash'):
         raise HTTPException(status_code=401, detail="Invalid credentials")
     
-    if not verify_password(credentials.password, user_data['password_hash']):
+    if not await run_bcrypt(verify_password, credentials.password, user_data['password_hash']):
         raise HTTPException(status_code=401, detail="Invalid credentials")
     
     if not user_data.get('is_active', True):
         raise HTTPException(status_code=401, detail="Account is inactive")
     
+    # Migrate hashes from older cost factors now that we have the plaintext
+    if password_needs_rehash(user_data['password_hash']):
+        new_hash = await run_bcrypt(hash_password, credentials.password)
+        await db.users.update_one({"id": user_data['id']}, {"$set": {"password_hash": new_hash}})
+    
     token = create_access_token({"user_id": user_data['id'], "email": user_data['email']})
     
     return {
@@ -340,7 +556,7 @@ async def process_google_session(request: Request, response: Response):
     
     # Get session data from Emergent
     try:
-        resp = requests.post(
+        resp = await http_client.post(
             "https://demobackend.emergentagent.com/auth/v1/env/oauth/session-data",
             headers={"X-Session-ID": session_id}
         )
@@ -364,19 +580,32 @@ async def process_google_session(request: Request, response: Response):
             role=UserRole.CLIENT,
             picture=picture
         )
-        await db.users.insert_one(user.model_dump())
-        user_id = user.id
+        try:
+            await db.users.insert_one(user.model_dump())
+            user_id = user.id
+        except DuplicateKeyError:
+            # A concurrent exchange created the user first
+            user_data = await db.users.find_one({"email": email}, {"_id": 0})
+            user_id = user_data['id']
     else:
         user_id = user_data['id']
     
-    # Create session
-    expires_at = datetime.now(timezone.utc) + timedelta(days=7)
+    # Create session, repeated exchanges of the same token refresh it
+    now = utc_now()
     session = SessionData(
         user_id=user_id,
         session_token=emergent_session_token,
-        expires_at=expires_at.isoformat()
+        expires_at=now + timedelta(days=7),
+        created_at=now
+    )
+    await db.sessions.update_one(
+        {"session_token": session.session_token},
+        {
+            "$set": {"user_id": session.user_id, "expires_at": session.expires_at},
+            "$setOnInsert": {"id": session.id, "created_at": session.created_at}
+        },
+        upsert=True
     )
-    await db.sessions.insert_one(session.model_dump())
     
     # Set cookie
     response.set_cookie(
@@ -391,6 +620,8 @@ async def process_google_session(request: Request, response: Response):
     
     # Get updated user data
     user_data = await db.users.find_one({"id": user_id}, {"_id": 0})
+    if user_data.get('is_active'):
+        await cache_session(emergent_session_token, user_data)
     
     return {
         "user": {
@@ -407,6 +638,7 @@ async def logout(request: Request, response: Response):
     session_token = request.cookies.get("session_token")
     if session_token:
         await db.sessions.delete_many({"session_token": session_token})
+        await delete_cached_sessions([session_token])
     response.delete_cookie(key="session_token", path="/")
     return {"message": "Logged out successfully"}
 
@@ -421,52 +653,49 @@ async def get_me(current_user: User = Depends(get_current_user)):
     }
 
 # Work Order Routes
-@api_router.get("/work-orders", response_model=List[WorkOrder])
-async def get_work_orders(current_user: User = Depends(get_current_user)):
-    query = {}
-    if current_user.role == UserRole.CLIENT:
-        query["client_id"] = current_user.id
-    elif current_user.role == UserRole.TECHNICIAN:
-        query["assigned_to_id"] = current_user.id
+# Hot list endpoints return documents as stored, skipping response model validation
+@api_router.get("/work-orders", response_model=None, responses={200: {"model": List[WorkOrderSummary]}})
+async def get_work_orders(
+    skip: int = Query(0, ge=0),
+    limit: int = Query(1000, ge=1, le=1000),
+    current_user: User = Depends(get_current_user)
+):
+    query = work_order_scope(current_user)
     
-    work_orders = await db.work_orders.find(query, {"_id": 0}).sort("created_at", -1).to_list(1000)
-    return work_orders
+    work_orders = await db.work_orders.find(query, WORK_ORDER_SUMMARY_PROJECTION).sort("created_at", -1).skip(skip).limit(limit).to_list(limit)
+    return ORJSONResponse(work_orders)
 
 @api_router.get("/work-orders/{work_order_id}", response_model=WorkOrder)
 async def get_work_order(work_order_id: str, current_user: User = Depends(get_current_user)):
-    work_order = await db.work_orders.find_one({"id": work_order_id}, {"_id": 0})
+    work_order = await db.work_orders.find_one(
+        {"id": work_order_id, **work_order_scope(current_user)},
+        {"_id": 0}
+    )
     if not work_order:
         raise HTTPException(status_code=404, detail="Work order not found")
-    
-    # Check permissions
-    if current_user.role == UserRole.CLIENT and work_order['client_id'] != current_user.id:
-        raise HTTPException(status_code=403, detail="Access denied")
-    if current_user.role == UserRole.TECHNICIAN and work_order['assigned_to_id'] != current_user.id:
-        raise HTTPException(status_code=403, detail="Access denied")
-    
     return work_order
 
 @api_router.post("/work-orders", response_model=WorkOrder)
 async def create_work_order(
     wo_data: WorkOrderCreate,
+    background_tasks: BackgroundTasks,
     current_user: User = Depends(require_role([UserRole.ADMIN, UserRole.SUPERVISOR]))
 ):
-    # Generate request ID
-    count = await db.work_orders.count_documents({})
-    request_id = f"WO-{count + 1:05d}"
-    
-    # Get client info
-    client = await db.users.find_one({"id": wo_data.client_id}, {"_id": 0})
-    if not client:
+    # Get client and assigned technician names in one query
+    user_ids = [wo_data.client_id] + ([wo_data.assigned_to_id] if wo_data.assigned_to_id else [])
+    names = {
+        u['id']: u['name']
+        async for u in db.users.find({"id": {"$in": user_ids}}, {"_id": 0, "id": 1, "name": 1})
+    }
+    if wo_data.client_id not in names:
         raise HTTPException(status_code=404, detail="Client not found")
+    assigned_to_name = names.get(wo_data.assigned_to_id)
     
-    # Get assigned technician info
-    assigned_to_name = None
-    if wo_data.assigned_to_id:
-        tech = await db.users.find_one({"id": wo_data.assigned_to_id}, {"_id": 0})
-        if tech:
-            assigned_to_name = tech['name']
+    # Generate request ID
+    seq = await next_sequence("work_order_seq")
+    request_id = f"WO-{seq:05d}"
     
+    now = utc_now()
     work_order = WorkOrder(
         request_id=request_id,
         title=wo_data.title,
@@ -476,20 +705,23 @@ async def create_work_order(
         location=wo_data.location,
         department=wo_data.department,
         client_id=wo_data.client_id,
-        client_name=client['name'],
+        client_name=names[wo_data.client_id],
         assigned_to_id=wo_data.assigned_to_id,
         assigned_to_name=assigned_to_name,
         start_date=wo_data.start_date,
         due_date=wo_data.due_date,
         duration_days=wo_data.duration_days,
         created_by_id=current_user.id,
-        created_by_name=current_user.name
+        created_by_name=current_user.name,
+        created_at=now,
+        updated_at=now
     )
     
     await db.work_orders.insert_one(work_order.model_dump())
     
-    # Create notifications
-    await create_notification(
+    # Create notifications after the response is sent
+    background_tasks.add_task(
+        create_notification,
         wo_data.client_id,
         "New Work Order",
         f"Work order {request_id} has been created",
@@ -497,7 +729,8 @@ async def create_work_order(
     )
     
     if wo_data.assigned_to_id:
-        await create_notification(
+        background_tasks.add_task(
+            create_notification,
             wo_data.assigned_to_id,
             "New Assignment",
             f"You have been assigned to work order {request_id}",
@@ -510,40 +743,44 @@ async def create_work_order(
 async def update_work_order(
     work_order_id: str,
     updates: WorkOrderUpdate,
+    background_tasks: BackgroundTasks,
     current_user: User = Depends(get_current_user)
 ):
-    work_order = await db.work_orders.find_one({"id": work_order_id}, {"_id": 0})
-    if not work_order:
-        raise HTTPException(status_code=404, detail="Work order not found")
-    
     # Check permissions
     if current_user.role == UserRole.CLIENT:
         raise HTTPException(status_code=403, detail="Clients cannot update work orders")
-    if current_user.role == UserRole.TECHNICIAN and work_order['assigned_to_id'] != current_user.id:
-        raise HTTPException(status_code=403, detail="You can only update your assigned work orders")
+    
+    work_order = await db.work_orders.find_one(
+        {"id": work_order_id, **work_order_scope(current_user)},
+        {"_id": 0, "request_id": 1, "client_id": 1}
+    )
+    if not work_order:
+        raise HTTPException(status_code=404, detail="Work order not found")
     
     update_data = {k: v for k, v in updates.model_dump().items() if v is not None}
     
     # Update assigned technician name if changed
     if 'assigned_to_id' in update_data and update_data['assigned_to_id']:
-        tech = await db.users.find_one({"id": update_data['assigned_to_id']}, {"_id": 0})
+        tech = await db.users.find_one({"id": update_data['assigned_to_id']}, {"_id": 0, "name": 1})
         if tech:
             update_data['assigned_to_name'] = tech['name']
             # Notify new assignee
-            await create_notification(
+            background_tasks.add_task(
+                create_notification,
                 update_data['assigned_to_id'],
                 "New Assignment",
                 f"You have been assigned to work order {work_order['request_id']}",
                 f"/work-orders/{work_order_id}"
             )
     
-    update_data['updated_at'] = datetime.now(timezone.utc).isoformat()
+    update_data['updated_at'] = utc_now()
     
     await db.work_orders.update_one({"id": work_order_id}, {"$set": update_data})
     
     # Notify client of status change
     if 'status' in update_data:
-        await create_notification(
+        background_tasks.add_task(
+            create_notification,
             work_order['client_id'],
             "Work Order Updated",
             f"Work order {work_order['request_id']} status changed to {update_data['status']}",
@@ -566,6 +803,7 @@ async def delete_work_order(
 # Comments Routes
 @api_router.get("/work-orders/{work_order_id}/comments", response_model=List[Comment])
 async def get_comments(work_order_id: str, current_user: User = Depends(get_current_user)):
+    await check_work_order_scope(work_order_id, current_user)
     comments = await db.comments.find({"work_order_id": work_order_id}, {"_id": 0}).sort("created_at", -1).to_list(100)
     return comments
 
@@ -575,8 +813,11 @@ async def create_comment(
     comment_data: CommentCreate,
     current_user: User = Depends(get_current_user)
 ):
-    # Verify work order exists
-    work_order = await db.work_orders.find_one({"id": work_order_id}, {"_id": 0})
+    # Verify work order exists and is visible to the user
+    work_order = await db.work_orders.find_one(
+        {"id": work_order_id, **work_order_scope(current_user)},
+        {"_id": 0, "id": 1}
+    )
     if not work_order:
         raise HTTPException(status_code=404, detail="Work order not found")
     
@@ -594,6 +835,7 @@ async def create_comment(
 # Cost Entries Routes
 @api_router.get("/work-orders/{work_order_id}/costs", response_model=List[CostEntry])
 async def get_cost_entries(work_order_id: str, current_user: User = Depends(get_current_user)):
+    await check_work_order_scope(work_order_id, current_user)
     costs = await db.cost_entries.find({"work_order_id": work_order_id}, {"_id": 0}).sort("created_at", -1).to_list(100)
     return costs
 
@@ -603,7 +845,10 @@ async def create_cost_entry(
     cost_data: CostEntryCreate,
     current_user: User = Depends(require_role([UserRole.ADMIN, UserRole.SUPERVISOR, UserRole.TECHNICIAN]))
 ):
-    work_order = await db.work_orders.find_one({"id": work_order_id}, {"_id": 0})
+    work_order = await db.work_orders.find_one(
+        {"id": work_order_id, **work_order_scope(current_user)},
+        {"_id": 0, "id": 1}
+    )
     if not work_order:
         raise HTTPException(status_code=404, detail="Work order not found")
     
@@ -619,11 +864,12 @@ async def create_cost_entry(
     await db.cost_entries.insert_one(cost_entry.model_dump())
     
     # Update total cost on work order
-    all_costs = await db.cost_entries.find({"work_order_id": work_order_id}, {"_id": 0}).to_list(1000)
-    total_cost = sum(c['amount'] for c in all_costs)
     await db.work_orders.update_one(
         {"id": work_order_id},
-        {"$set": {"total_cost": total_cost, "updated_at": datetime.now(timezone.utc).isoformat()}}
+        {
+            "$inc": {"total_cost": cost_entry.amount},
+            "$set": {"updated_at": utc_now()}
+        }
     )
     
     return cost_entry
@@ -631,19 +877,22 @@ async def create_cost_entry(
 # Preventive Maintenance Routes
 @api_router.get("/preventive-maintenance", response_model=List[PreventiveMaintenance])
 async def get_preventive_maintenance(
+    skip: int = Query(0, ge=0),
+    limit: int = Query(1000, ge=1, le=1000),
     current_user: User = Depends(require_role([UserRole.ADMIN, UserRole.SUPERVISOR]))
 ):
-    pms = await db.preventive_maintenance.find({}, {"_id": 0}).sort("next_due_date", 1).to_list(1000)
+    pms = await db.preventive_maintenance.find({}, {"_id": 0}).sort("next_due_date", 1).skip(skip).limit(limit).to_list(limit)
     return pms
 
 @api_router.post("/preventive-maintenance", response_model=PreventiveMaintenance)
 async def create_preventive_maintenance(
     pm_data: PreventiveMaintenanceCreate,
+    background_tasks: BackgroundTasks,
     current_user: User = Depends(require_role([UserRole.ADMIN, UserRole.SUPERVISOR]))
 ):
     assigned_to_name = None
     if pm_data.assigned_to_id:
-        tech = await db.users.find_one({"id": pm_data.assigned_to_id}, {"_id": 0})
+        tech = await db.users.find_one({"id": pm_data.assigned_to_id}, {"_id": 0, "name": 1})
         if tech:
             assigned_to_name = tech['name']
     
@@ -660,7 +909,8 @@ async def create_preventive_maintenance(
     await db.preventive_maintenance.insert_one(pm.model_dump())
     
     if pm_data.assigned_to_id:
-        await create_notification(
+        background_tasks.add_task(
+            create_notification,
             pm_data.assigned_to_id,
             "New Preventive Maintenance Task",
             f"You have been assigned to: {pm_data.title}",
@@ -671,8 +921,12 @@ async def create_preventive_maintenance(
 
 # User Management Routes
 @api_router.get("/users", response_model=List[User])
-async def get_users(current_user: User = Depends(require_role([UserRole.ADMIN, UserRole.SUPERVISOR]))):
-    users = await db.users.find({}, {"_id": 0, "password_hash": 0}).to_list(1000)
+async def get_users(
+    skip: int = Query(0, ge=0),
+    limit: int = Query(1000, ge=1, le=1000),
+    current_user: User = Depends(require_role([UserRole.ADMIN, UserRole.SUPERVISOR]))
+):
+    users = await db.users.find({}, {"_id": 0, "password_hash": 0}).sort("_id", 1).skip(skip).limit(limit).to_list(limit)
     return users
 
 @api_router.patch("/users/{user_id}")
@@ -688,6 +942,8 @@ async def update_user(
     result = await db.users.update_one({"id": user_id}, {"$set": updates})
     if result.matched_count == 0:
         raise HTTPException(status_code=404, detail="User not found")
+    user_cache.pop(user_id, None)
+    await invalidate_user_sessions(user_id)
     
     return {"message": "User updated successfully"}
 
@@ -699,16 +955,22 @@ async def deactivate_user(
     result = await db.users.update_one({"id": user_id}, {"$set": {"is_active": False}})
     if result.matched_count == 0:
         raise HTTPException(status_code=404, detail="User not found")
+    user_cache.pop(user_id, None)
+    await invalidate_user_sessions(user_id)
     return {"message": "User deactivated successfully"}
 
 # Notifications Routes
-@api_router.get("/notifications", response_model=List[Notification])
-async def get_notifications(current_user: User = Depends(get_current_user)):
+@api_router.get("/notifications", response_model=None, responses={200: {"model": List[Notification]}})
+async def get_notifications(
+    skip: int = Query(0, ge=0),
+    limit: int = Query(50, ge=1, le=200),
+    current_user: User = Depends(get_current_user)
+):
     notifications = await db.notifications.find(
         {"user_id": current_user.id},
         {"_id": 0}
-    ).sort("created_at", -1).limit(50).to_list(50)
-    return notifications
+    ).sort("created_at", -1).skip(skip).limit(limit).to_list(limit)
+    return ORJSONResponse(notifications)
 
 @api_router.patch("/notifications/{notification_id}/read")
 async def mark_notification_read(
@@ -748,7 +1010,7 @@ async def update_settings(
     current_user: User = Depends(require_role([UserRole.ADMIN]))
 ):
     update_data = {k: v for k, v in updates.model_dump().items() if v is not None}
-    update_data['updated_at'] = datetime.now(timezone.utc).isoformat()
+    update_data['updated_at'] = utc_now()
     
     result = await db.company_settings.update_one(
         {"id": "company_settings"},
@@ -760,21 +1022,22 @@ async def update_settings(
 # Dashboard Stats Routes
 @api_router.get("/dashboard/stats")
 async def get_dashboard_stats(current_user: User = Depends(get_current_user)):
-    query = {}
-    if current_user.role == UserRole.CLIENT:
-        query["client_id"] = current_user.id
-    elif current_user.role == UserRole.TECHNICIAN:
-        query["assigned_to_id"] = current_user.id
+    query = work_order_scope(current_user)
     
-    total_orders = await db.work_orders.count_documents(query)
-    pending = await db.work_orders.count_documents({**query, "status": WorkOrderStatus.PENDING})
-    in_progress = await db.work_orders.count_documents({**query, "status": WorkOrderStatus.IN_PROGRESS})
-    completed = await db.work_orders.count_documents({**query, "status": WorkOrderStatus.COMPLETED})
-    approved = await db.work_orders.count_documents({**query, "status": WorkOrderStatus.APPROVED})
+    # Count and sum costs per status in a single round-trip
+    cursor = await db.work_orders.aggregate([
+        {"$match": query},
+        {"$group": {"_id": "$status", "count": {"$sum": 1}, "cost": {"$sum": {"$ifNull": ["$total_cost", 0]}}}}
+    ])
+    groups = await cursor.to_list(None)
+    counts = {g['_id']: g['count'] for g in groups}
     
-    # Calculate total costs
-    work_orders = await db.work_orders.find(query, {"_id": 0, "total_cost": 1}).to_list(1000)
-    total_cost = sum(wo.get('total_cost', 0) for wo in work_orders)
+    total_orders = sum(counts.values())
+    pending = counts.get(WorkOrderStatus.PENDING.value, 0)
+    in_progress = counts.get(WorkOrderStatus.IN_PROGRESS.value, 0)
+    completed = counts.get(WorkOrderStatus.COMPLETED.value, 0)
+    approved = counts.get(WorkOrderStatus.APPROVED.value, 0)
+    total_cost = sum(g['cost'] for g in groups)
     
     completion_rate = (completed + approved) / total_orders * 100 if total_orders > 0 else 0
     
@@ -805,6 +1068,76 @@ logging.basicConfig(
 )
 logger = logging.getLogger(__name__)
 
+async def ensure_index(collection, keys, **kwargs):
+    # Existing duplicates can block a unique index, keep serving without it
+    try:
+        await collection.create_index(keys, **kwargs)
+    except PyMongoError as e:
+        logger.warning(f"Failed to create index {keys} on {collection.name}: {e}")
+
+@app.on_event("startup")
+async def init_db():
+    # Indexes for the lookups and sorts used by the routes above
+    await asyncio.gather(
+        ensure_index(db.users, "id", unique=True),
+        ensure_index(db.users, "email", unique=True),
+        ensure_index(db.sessions, "session_token", unique=True),
+        ensure_index(db.sessions, "user_id"),
+        ensure_index(db.sessions, "expires_at", expireAfterSeconds=0),
+        ensure_index(db.work_orders, "id", unique=True),
+        ensure_index(db.work_orders, "request_id", unique=True),
+        ensure_index(db.work_orders, [("created_at", -1)]),
+        ensure_index(db.work_orders, [("client_id", 1), ("created_at", -1)]),
+        ensure_index(db.work_orders, [("assigned_to_id", 1), ("created_at", -1)]),
+        ensure_index(db.comments, [("work_order_id", 1), ("created_at", -1)]),
+        ensure_index(db.cost_entries, [("work_order_id", 1), ("created_at", -1)]),
+        ensure_index(db.preventive_maintenance, "next_due_date"),
+        ensure_index(db.notifications, [("user_id", 1), ("created_at", -1)]),
+        ensure_index(db.notifications, [("is_read", 1), ("created_at", 1)]),
+    )
+    
+    # Sessions with string expiry can no longer authenticate and the TTL
+    # index ignores them, remove them here
+    result = await db.sessions.delete_many({"expires_at": {"$type": "string"}})
+    if result.deleted_count:
+        logger.info(f"Removed {result.deleted_count} legacy sessions with string expiry")
+    
+    # Keep the request ID counter at or above the highest issued number, so
+    # deleted work orders never cause a request ID to be reissued
+    cursor = await db.work_orders.aggregate([
+        {"$match": {"request_id": {"$regex": r"^WO-\d+$"}}},
+        {"$group": {"_id": None, "max_seq": {"$max": {"$toInt": {"$substrCP": ["$request_id", 3, 20]}}}}}
+    ])
+    result = await cursor.to_list(1)
+    await db.counters.update_one(
+        {"_id": "work_order_seq"},
+        {"$max": {"seq": result[0]['max_seq'] if result else 0}},
+        upsert=True
+    )
+
+@app.on_event("startup")
+async def startup_bcrypt_pool():
+    global bcrypt_pool
+    bcrypt_pool = ProcessPoolExecutor(max_workers=os.cpu_count())
+
+@app.on_event("startup")
+async def startup_http_client():
+    global http_client
+    http_client = httpx.AsyncClient(timeout=5.0, limits=httpx.Limits(max_keepalive_connections=20))
+
+@app.on_event("startup")
+async def startup_notification_sweeper():
+    global notification_sweeper
+    notification_sweeper = asyncio.create_task(sweep_read_notifications())
+
 @app.on_event("shutdown")
 async def shutdown_db_client():
-    client.close()
\ No newline at end of file
+    if notification_sweeper:
+        notification_sweeper.cancel()
+    await client.close()
+    if bcrypt_pool:
+        bcrypt_pool.shutdown()
+    if http_client:
+        await http_client.aclose()
+    if redis_client:
+        await redis_client.aclose()
\ No newline at end of file